@@ -8,20 +8,27 @@
 from argparse import ArgumentParser
 from datetime import datetime
 from email.utils import format_datetime, localtime
-from git import Repo
+from functools import lru_cache
+from git import GitCommandError, Repo
 from os import getenv
 import os.path
 from packaging.version import Version
-from subprocess import run, PIPE
+import pickle
+import platform
+from subprocess import run
 import sys
-from yaml import load, SafeLoader
+from yaml import load
 
-# Determine top level directory of this repository ("jellyfin-packaging")
-revparse = run(["git", "rev-parse", "--show-toplevel"], stdout=PIPE)
-repo_root_dir = revparse.stdout.decode().strip()
+# Prefer the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 # Base Docker commands
 docker_build_cmd = "docker buildx build --progress=plain --no-cache"
+# The Docker image busts its network-dependent layers with BUILD_DATE, so the rest may be cached
+docker_image_build_cmd = "docker buildx build --progress=plain"
 docker_run_cmd = "docker run --rm"
 
 
@@ -30,47 +37,78 @@ def log(message):
 
 
 # Configuration loader
+#   The parsed configuration is cached as a pickle next to "build.yaml" and
+#   reused as long as the cache is at least as new as the YAML source
+config_file = "build.yaml"
+config_cache = os.path.join(os.path.dirname(config_file), ".build.yaml.pickle")
+
+
+def _load_configurations():
+    try:
+        if os.path.getmtime(config_cache) >= os.path.getmtime(config_file):
+            with open(config_cache, "rb") as fh:
+                return pickle.load(fh)
+    except Exception:
+        pass
+
+    with open(config_file, encoding="utf-8") as fh:
+        config = load(fh, Loader=SafeLoader)
+
+    try:
+        with open(config_cache, "wb") as fh:
+            pickle.dump(config, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
+    return config
+
+
 try:
-    with open("build.yaml", encoding="utf-8") as fh:
-        configurations = load(fh, Loader=SafeLoader)
+    configurations = _load_configurations()
 except Exception as e:
     log(f"Error: Failed to find 'build.yaml' configuration: {e}")
     exit(1)
 
+# Pre-sort the framework commit maps into (commit_hash, version) lists ordered by version;
+# each version string is parsed once into a (Version, commit_hash, version) sort key
+for _framework_map in configurations.get("frameworks", {}).values():
+    for _framework_arg, _commits in _framework_map.items():
+        _keyed = sorted((Version(str(v)), h, v) for h, v in _commits.items())
+        _framework_map[_framework_arg] = [(h, v) for _, h, v in _keyed]
+
 
 # Shared functions
 def _determine_arch(build_type, build_arch, build_version):
+    archmaps = configurations[build_type]["archmaps"]
     PACKAGE_ARCH = (
-        configurations[build_type]["archmaps"][build_arch]["PACKAGE_ARCH"]
-        if build_arch in configurations[build_type]["archmaps"].keys()
+        archmaps[build_arch]["PACKAGE_ARCH"]
+        if build_arch in archmaps
         else None
     )
     if PACKAGE_ARCH is None:
         raise ValueError(
-            f"{build_arch} is not a valid {build_type} {build_version} architecture in {configurations[build_type]['archmaps'].keys()}"
+            f"{build_arch} is not a valid {build_type} {build_version} architecture in {archmaps.keys()}"
         )
     else:
         return PACKAGE_ARCH
 
+@lru_cache(maxsize=1)
 def _determine_framework_versions():
-    # Prepare repo object for this repository
-    this_repo = Repo(repo_root_dir)
-
+    frameworks = configurations["frameworks"]
     framework_args = dict()
 
     for submodule in this_repo.submodules:
-        if submodule.name in configurations["frameworks"].keys():
-            for framework_arg in configurations["frameworks"][submodule.name].keys():
+        if submodule.name in frameworks:
+            module = submodule.module()
+            for framework_arg, commits in frameworks[submodule.name].items():
                 framework_args[framework_arg] = None
-                def sort_versions(input_dict):
-                    return dict(sorted(input_dict.items(), key=lambda item: Version(str(item[1]))))
-                for commit_hash in sort_versions(configurations["frameworks"][submodule.name][framework_arg]):
+                for commit_hash, version in commits:
+                    # Exits non-zero if the commit is unknown or not an ancestor of HEAD
                     try:
-                        commit = submodule.module().commit(commit_hash)
-                        if commit in submodule.module().iter_commits('HEAD'):
-                            framework_args[framework_arg] = configurations["frameworks"][submodule.name][framework_arg][commit_hash]
-                    except ValueError:
+                        module.git.merge_base("--is-ancestor", commit_hash, "HEAD")
+                    except GitCommandError:
                         continue
+                    framework_args[framework_arg] = version
 
     log(f"Determined the following framework versions based on current HEAD values:")
     for k, v in framework_args.items():
@@ -399,7 +437,7 @@ def build_docker(
     jellyfin_version, build_type, build_arch, _build_version, local=False, debug=False
 ):
     """
-    Build Docker images for one or all architectures and combining manifests
+    Build a multi-architecture Docker image and push it with all of its tags
     """
     log("> Building Docker images...")
 
@@ -407,7 +445,8 @@ def build_docker(
         log(f"NOTE: Building only for arch {build_arch}")
 
     # We build all architectures simultaneously to push a single tag, so no conditional checks
-    architectures = configurations["docker"]["archmaps"].keys()
+    archmaps = configurations["docker"]["archmaps"]
+    architectures = archmaps.keys()
 
     if build_arch:
         if build_arch not in architectures:
@@ -416,6 +455,11 @@ def build_docker(
         else:
             architectures = [build_arch]
 
+    # "--load" can only import a single-platform image into the local image store
+    if local and len(architectures) > 1:
+        log("Error: A local Docker build requires a single architecture; specify one.")
+        exit(1)
+
     # Set the dockerfile
     dockerfile = configurations[build_type]["dockerfile"]
 
@@ -438,202 +482,120 @@ def build_docker(
     # Set today's date in a convenient format for use as an image suffix
     date = datetime.now().strftime("%Y%m%d-%H%M%S")
 
-    images_hub = list()
-    images_ghcr = list()
-    for _build_arch in architectures:
-        log(f">> Building Docker image for {_build_arch}...")
-        log("")
+    # Build every architecture in one buildx invocation; the per-arch values are
+    # derived inside the Dockerfile from the TARGETARCH buildx sets per platform
+    platforms = [
+        f"linux/{archmaps[_build_arch]['TARGET_ARCH']}"
+        for _build_arch in architectures
+    ]
 
-        # Get our ARCH variables from the archmaps
-        PACKAGE_ARCH = configurations["docker"]["archmaps"][_build_arch]["PACKAGE_ARCH"]
-        DOTNET_ARCH = configurations["docker"]["archmaps"][_build_arch]["DOTNET_ARCH"]
-        IMAGE_ARCH = configurations["docker"]["archmaps"][_build_arch]["IMAGE_ARCH"]
-        TARGET_ARCH = configurations["docker"]["archmaps"][_build_arch]["TARGET_ARCH"]
-        QEMU_ARCH = configurations["docker"]["archmaps"][_build_arch]["QEMU_ARCH"]
+    # Determine the tag names (without server) for the multi-arch image
+    tag_versions = list()
+    if is_stable or is_preview:
+        tag_versions.append(f"{jellyfin_version}.{date}")
+    tag_versions.append(jellyfin_version)
+    if is_stable:
+        # Major-minor and major-only point versions
+        version_parts = jellyfin_version.split('.')
+        tag_versions.append('.'.join(version_parts[0:2]))
+        tag_versions.append(version_parts[0])
+        tag_versions.append("latest")
+    elif is_preview:
+        tag_versions.append("preview")
+    else:
+        tag_versions.append("unstable")
+
+    def build_tags(server):
+        # Determine the tags for the multi-arch image on the given server
+        prefix = f"{server}/{configurations['docker']['imagename']}"
+        return [f"{prefix}:{tag_version}" for tag_version in tag_versions]
+
+    # Determine whether we push the result, and where to
+    push = not local
+    if push and (not getenv('DOCKER_USERNAME') or not getenv('DOCKER_TOKEN')):
+        log("Warning: No DOCKER_USERNAME or DOCKER_TOKEN in environment; skipping push (DockerHub and GHCR).")
+        push = False
+    # GHCR is optional; only push there when its own credentials are present
+    push_ghcr = push and bool(getenv('GHCR_USERNAME')) and bool(getenv('GHCR_TOKEN'))
+    if push and not push_ghcr:
+        log("Warning: No GHCR_USERNAME or GHCR_TOKEN in environment; skipping push to GHCR.")
 
+    if local:
         # Use a unique docker image name for consistency
+        arch_suffix = f"-{next(iter(architectures))}"
         if is_stable or is_preview:
-            imagename = f"{configurations['docker']['imagename']}:{jellyfin_version}-{_build_arch}.{date}"
+            tags = [f"{configurations['docker']['imagename']}:{jellyfin_version}{arch_suffix}.{date}"]
         else:
-            imagename = f"{configurations['docker']['imagename']}:{jellyfin_version}-{_build_arch}"
-
-        # Clean up any existing qemu static image
-        log(
-            f">>> {docker_run_cmd} --privileged linuxserver/qemu-static --reset -p yes"
-        )
-        os.system(
-            f"{docker_run_cmd} --privileged linuxserver/qemu-static --reset -p yes"
-        )
+            tags = [f"{configurations['docker']['imagename']}:{jellyfin_version}{arch_suffix}"]
+    else:
+        tags = build_tags("docker.io")
+        if push_ghcr:
+            tags += build_tags("ghcr.io")
+
+    # Clean up any existing qemu static image; only needed when emulating a foreign architecture
+    host_arch = {"x86_64": "amd64", "aarch64": "arm64"}.get(platform.machine())
+    if any(_build_arch != host_arch for _build_arch in architectures):
+        qemu_cmd = [*docker_run_cmd.split(), "--privileged", "linuxserver/qemu-static", "--reset", "-p", "yes"]
+        log(f">>> {' '.join(qemu_cmd)}")
+        run(qemu_cmd)
         log("")
 
-        # Prepare the list of build-args
-        build_args = list()
-        build_args.append(f"--build-arg PACKAGE_ARCH={PACKAGE_ARCH}")
-        build_args.append(f"--build-arg DOTNET_ARCH={DOTNET_ARCH}")
-        build_args.append(f"--build-arg IMAGE_ARCH={IMAGE_ARCH}")
-        build_args.append(f"--build-arg TARGET_ARCH={TARGET_ARCH}")
-        build_args.append(f"--build-arg QEMU_ARCH={QEMU_ARCH}")
-        build_args.append(f"--build-arg JELLYFIN_VERSION={jellyfin_version}")
-        build_args.append(f"--build-arg CONFIG={'Debug' if debug else 'Release'}")
-
-        # Determine framework versions
-        framework_versions = _determine_framework_versions()
-        for arg in framework_versions.keys():
-            if framework_versions[arg] is not None:
-                build_args.append(
-                    f"--build-arg {arg}={framework_versions[arg]}"
-                )
-
-        if local:
-            build_args.append("--load")
-
-        build_args = ' '.join(build_args)
-
-        # Build the dockerfile
-        log(
-            f">>> {docker_build_cmd} {build_args} --file {repo_root_dir}/{dockerfile} --tag {imagename} {repo_root_dir}"
-        )
-        ret = os.system(
-            f"{docker_build_cmd} {build_args} --file {repo_root_dir}/{dockerfile} --tag {imagename} {repo_root_dir}"
-        )
-        if ret > 0:
-            exit(1)
-        images_hub.append(imagename)
+    # Prepare the list of build-args
+    build_args = list()
+    build_args += ["--platform", ','.join(platforms)]
+    build_args += ["--build-arg", f"JELLYFIN_VERSION={jellyfin_version}"]
+    build_args += ["--build-arg", f"CONFIG={'Debug' if debug else 'Release'}"]
+    # Invalidate the cached layers that fetch packages and plugins from the network
+    build_args += ["--build-arg", f"BUILD_DATE={date}"]
 
-        if not local:
-            os.system(f"docker image tag {imagename} ghcr.io/{imagename}")
-            images_ghcr.append(f"ghcr.io/{imagename}")
+    # Determine framework versions
+    framework_versions = _determine_framework_versions()
+    for arg in framework_versions.keys():
+        if framework_versions[arg] is not None:
+            build_args += ["--build-arg", f"{arg}={framework_versions[arg]}"]
 
-        log("")
+    for tag in tags:
+        build_args += ["--tag", tag]
 
     if local:
-        return
-
-    if not getenv('DOCKER_USERNAME') or not getenv('DOCKER_TOKEN'):
-        log("Warning: No DOCKER_USERNAME or DOCKER_TOKEN in environment; skipping manifest build and push (DockerHub and GHCR).")
-        return
-
-    def build_manifests(server, images):
-        # Build the manifests
-        log(f">> Building Docker manifests for {server}...")
-        manifests = list()
-
-        if is_stable or is_preview:
-            log(">>> Building X.Y.Z dated version manifest...")
-            log(
-                f">>>> docker manifest create {server}/{configurations['docker']['imagename']}:{jellyfin_version}.{date} {' '.join(images)}"
-            )
-            os.system(
-                f"docker manifest create {server}/{configurations['docker']['imagename']}:{jellyfin_version}.{date} {' '.join(images)}"
-            )
-            manifests.append(
-                f"{server}/{configurations['docker']['imagename']}:{jellyfin_version}.{date}"
-            )
-
-        log(">>> Building X.Y.Z version manifest...")
-        log(
-            f">>>> docker manifest create {server}/{configurations['docker']['imagename']}:{jellyfin_version} {' '.join(images)}"
-        )
-        os.system(
-            f"docker manifest create {server}/{configurations['docker']['imagename']}:{jellyfin_version} {' '.join(images)}"
-        )
-        manifests.append(f"{server}/{configurations['docker']['imagename']}:{jellyfin_version}")
-
-        if is_stable:
-            # Build major-minor point version
-            log(">>> Building X.Y version manifest...")
-            manifest_version_xy = '.'.join(jellyfin_version.split('.')[0:2])
-            log(
-                f">>>> docker manifest create {server}/{configurations['docker']['imagename']}:{manifest_version_xy} {' '.join(images)}"
-            )
-            os.system(
-                f"docker manifest create {server}/{configurations['docker']['imagename']}:{manifest_version_xy} {' '.join(images)}"
-            )
-            manifests.append(f"{server}/{configurations['docker']['imagename']}:{manifest_version_xy}")
-
-            # Build major-only point version
-            log(">>> Building X version manifest...")
-            manifest_version_x = '.'.join(jellyfin_version.split('.')[0:1])
-            log(
-                f">>>> docker manifest create {server}/{configurations['docker']['imagename']}:{manifest_version_x} {' '.join(images)}"
-            )
-            os.system(
-                f"docker manifest create {server}/{configurations['docker']['imagename']}:{manifest_version_x} {' '.join(images)}"
-            )
-            manifests.append(f"{server}/{configurations['docker']['imagename']}:{manifest_version_x}")
-
-            log(">>> Building latest manifest...")
-            log(
-                f">>>> docker manifest create {server}/{configurations['docker']['imagename']}:latest {' '.join(images)}"
-            )
-            os.system(
-                f"docker manifest create {server}/{configurations['docker']['imagename']}:latest {' '.join(images)}"
-            )
-            manifests.append(f"{server}/{configurations['docker']['imagename']}:latest")
-        elif is_preview:
-            log(">>> Building preview manifest...")
-            log(
-                f">>>> docker manifest create {server}/{configurations['docker']['imagename']}:preview {' '.join(images)}"
-            )
-            os.system(
-                f"docker manifest create {server}/{configurations['docker']['imagename']}:preview {' '.join(images)}"
-            )
-            manifests.append(f"{server}/{configurations['docker']['imagename']}:preview")
-        else:
-            log(">>> Building unstable manifest...")
-            log(
-                f">>>> docker manifest create {server}/{configurations['docker']['imagename']}:unstable {' '.join(images)}"
-            )
-            os.system(
-                f"docker manifest create {server}/{configurations['docker']['imagename']}:unstable {' '.join(images)}"
-            )
-            manifests.append(f"{server}/{configurations['docker']['imagename']}:unstable")
-
-        return manifests
-
-    # Log in to DockerHub
-    os.system(
-        f"docker login -u {getenv('DOCKER_USERNAME')} -p {getenv('DOCKER_TOKEN')} 2>&1"
-    )
-
-    # Push the images to DockerHub
-    for image in images_hub:
-        log(f">>> Pushing image {image} to DockerHub")
-        log(f">>>> docker push {image} 2>&1")
-        os.system(f"docker push {image} 2>&1")
-
-    manifests_hub = build_manifests("docker.io", images_hub)
-
-    # Push the images and manifests to DockerHub
-    for manifest in manifests_hub:
-        log(f">>> Pushing manifest {manifest} to DockerHub")
-        log(f">>>> docker manifest push --purge {manifest} 2>&1")
-        os.system(f"docker manifest push --purge {manifest} 2>&1")
-
-    # Log out of DockerHub
-    os.system("docker logout")
-
-    # Log in to GHCR
-    os.system(
-        f"docker login -u {getenv('GHCR_USERNAME')} -p {getenv('GHCR_TOKEN')} ghcr.io 2>&1"
-    )
-
-    # Push the images to GHCR
-    for image in images_ghcr:
-        log(f">>> Pushing image {image} to GHCR")
-        log(f">>>> docker push {image} 2>&1")
-        os.system(f"docker push {image} 2>&1")
-
-    manifests_ghcr = build_manifests("ghcr.io", images_ghcr)
+        build_args.append("--load")
+    elif push:
+        build_args.append("--push")
+
+    def logout():
+        # Log out of DockerHub and GHCR
+        run(["docker", "logout"])
+        if push_ghcr:
+            run(["docker", "logout", "ghcr.io"])
+
+    if push:
+        # Log in to DockerHub and GHCR so buildx can push the image and its manifest list;
+        # the tokens are passed on stdin to keep them out of the process list
+        logins = [(None, getenv('DOCKER_USERNAME'), getenv('DOCKER_TOKEN'))]
+        if push_ghcr:
+            logins.append(("ghcr.io", getenv('GHCR_USERNAME'), getenv('GHCR_TOKEN')))
+        for server, username, token in logins:
+            login_cmd = ["docker", "login", "-u", username, "--password-stdin"]
+            if server:
+                login_cmd.append(server)
+            if run(login_cmd, input=token, text=True).returncode > 0:
+                log(f"Error: Failed to log in to {server or 'DockerHub'}; not building.")
+                logout()
+                exit(1)
+
+    # Build the dockerfile for all platforms
+    log(f">> Building Docker image for {', '.join(architectures)}...")
+    log("")
+    build_cmd = [*docker_image_build_cmd.split(), *build_args, "--file", f"{repo_root_dir}/{dockerfile}", repo_root_dir]
+    log(f">>> {' '.join(build_cmd)}")
+    ret = run(build_cmd).returncode
 
-    # Push the images and manifests to GHCR
-    for manifest in manifests_ghcr:
-        log(f">>> Pushing manifest {manifest} to GHCR")
-        log(f">>>> docker manifest push --purge {manifest} 2>&1")
-        os.system(f"docker manifest push --purge {manifest} 2>&1")
+    if push:
+        logout()
 
-    # Log out of GHCR
-    os.system("docker logout")
+    if ret > 0:
+        exit(1)
+    log("")
 
 
 def build_nuget(
@@ -744,6 +706,11 @@ parser.add_argument('--debug', action='store_true', help='Debug build, set .NET
 
 args = parser.parse_args()
 
+# Determine top level directory of this repository ("jellyfin-packaging"); this is
+# done after argument parsing so that "--help" does not need to touch git
+this_repo = Repo(".", search_parent_directories=True)
+repo_root_dir = this_repo.working_tree_dir
+
 jellyfin_version = args.jellyfin_version
 build_type = args.build_type
 build_arch = args.build_arch
@@ -5,11 +5,12 @@
 # Part of the Jellyfin CI system
 ###############################################################################
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from subprocess import run, PIPE
 import sys
 
-from git import Repo
+from git import GitCommandError, Repo
 
 try:
     target_release = sys.argv[1]
@@ -25,10 +26,11 @@ revparse_dir = revparse.stdout.decode().strip()
 # Prepare repo object for this repository
 this_repo = Repo(revparse_dir)
 
-# Update all the submodules
+# Update all the submodules, fetching them in parallel; new clones are blobless
+# (full commit history for build.py's framework checks, file contents on demand)
 while True:
     try:
-        this_repo.submodule_update(init=True, recursive=True)
+        this_repo.git.submodule("update", "--init", "--recursive", "--jobs=8", "--filter=blob:none")
         break
     except Exception as e:
         print(e)
@@ -39,18 +41,29 @@ submodules = dict()
 for submodule in this_repo.submodules:
     submodules[submodule.name] = submodule.module()
 
+
+def has_tag(submodule, tag):
+    # Resolve the exact tag ref; "git tag -l" would treat the name as a glob
+    try:
+        submodule.git.rev_parse("--verify", "--quiet", f"refs/tags/{tag}")
+        return True
+    except GitCommandError:
+        return False
+
+
 # Validate that the provided tag is valid; if not, fall back to "master"
 if target_release != "master":
     if (
-        target_release not in submodules["jellyfin-server"].tags
-        or target_release not in submodules["jellyfin-web"].tags
+        not has_tag(submodules["jellyfin-server"], target_release)
+        or not has_tag(submodules["jellyfin-web"], target_release)
     ):
         print(
             f"WARNING: Provided tag {target_release} is not a valid tag for both jellyfin-server and jellyfin-web; using master instead"
         )
         target_release = "master"
 
-for submodule in submodules.keys():
+
+def checkout_submodule(submodule):
     if target_release == "master" or submodule == 'jellyfin-server-windows':
         target_head = "origin/master"
     else:
@@ -58,10 +71,14 @@ for submodule in submodules.keys():
     # Checkout the given head and reset the working tree
     submodules[submodule].head.reference = target_head
     submodules[submodule].head.reset(index=True, working_tree=True)
-    sha = submodules[submodule].head.object.hexsha
-    author = submodules[submodule].head.object.author.name
-    summary = submodules[submodule].head.object.summary
-    date = datetime.fromtimestamp(submodules[submodule].head.object.committed_date)
-    print(f"Submodule {submodule} now at {target_head} (\"{summary}\" commit {sha} by {author} @ {date})")
+    commit = submodules[submodule].head.commit
+    date = datetime.fromtimestamp(commit.committed_date)
+    return f"Submodule {submodule} now at {target_head} (\"{commit.summary}\" commit {commit.hexsha} by {commit.author.name} @ {date})"
+
+
+# Each submodule is an independent repository, so check them out in parallel
+with ThreadPoolExecutor(max_workers=min(8, len(submodules))) as executor:
+    for result in executor.map(checkout_submodule, submodules.keys()):
+        print(result)
 
 print(f"Successfully checked out submodules to ref {target_release}")
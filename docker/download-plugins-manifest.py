@@ -5,103 +5,227 @@ Queries manifest.json and downloads plugins built for the HIGHEST server version
 Generates meta.json files for proper plugin management
 """
 
+import hashlib
 import json
-import urllib.request
-import urllib.error
+import logging
 import zipfile
 import os
 import sys
-import glob
+import shutil
+import tempfile
+import types
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Prefer orjson's C parser/serializer when it is installed
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj):
+        return json.dumps(obj, indent=2, sort_keys=True, ensure_ascii=False).encode("utf-8")
+
+log = logging.getLogger("download-plugins")
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """Stream handler that leaves flushing to the stream's own buffer instead of flushing every record"""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        # logging.shutdown() closes handlers at exit, so the buffered output is written out once here
+        with self.lock:
+            self.stream.flush()
+        super().close()
+
 MANIFEST_URL = "https://www.iamparadox.dev/jellyfin/plugins/manifest.json"
 
 HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; wget/1.21)"}
 
+# Image file extensions usable as a plugin imagePath, in order of preference
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.svg', '.gif')
+
+# Environment variable names for plugins that don't follow the <NAME>_VERSION default
+ENV_VAR_MAP = types.MappingProxyType({
+    "CustomTabs": "CUSTOMTABS_VERSION",
+    "PluginPages": "PLUGINPAGES_VERSION",
+})
+
+# Manifest bodies and their ETag/Last-Modified validators, for conditional requests
+MANIFEST_CACHE_DIR = Path("/tmp/.manifest_cache")
+
+# Seconds to wait for a connection and between reads of the response; not a cap
+# on the total time of a download
+REQUEST_TIMEOUT = (10, 30)
+
+# Shared HTTP session so connections (and TLS handshakes) are reused across downloads
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET', 'HEAD'],
+        # A Retry-After header could otherwise stall the build for hours
+        respect_retry_after_header=False,
+    ),
+))
+
+def write_cache_file(path, data):
+    """Atomically replace a cache file so readers never see a partial write"""
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp:
+        tmp.write(data)
+    os.replace(tmp.name, path)
+
 def download_manifest(url, name="manifest"):
     """Download and parse a manifest.json file"""
-    print(f"=== Downloading {name} ===")
-    print(f"URL: {url}")
-    print()
+    log.info(f"=== Downloading {name} ===")
+    log.info(f"URL: {url}")
+    log.info("")
+
+    cache_key = hashlib.sha256(url.encode()).hexdigest()
+    cache_body = MANIFEST_CACHE_DIR / f"{cache_key}.json"
+    cache_meta = MANIFEST_CACHE_DIR / f"{cache_key}.meta"
 
+    # Revalidate a previously cached copy instead of transferring it again;
+    # an unreadable or corrupt cache is treated as a miss
+    headers = {}
+    cached_manifest = None
     try:
-        print(f"Fetching {name}...")
-        req = urllib.request.Request(url, headers=HEADERS)
-        with urllib.request.urlopen(req) as response:
-            manifest = json.loads(response.read())
-        print(f"✓ {name} downloaded")
-        print()
+        validators = json_loads(cache_meta.read_bytes())
+        cached_manifest = json_loads(cache_body.read_bytes())
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    except Exception:
+        headers = {}
+
+    try:
+        log.info(f"Fetching {name}...")
+        with SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code == 304 and headers:
+                log.info(f"✓ {name} unchanged, using cached copy")
+                log.info("")
+                return cached_manifest
+            response.raise_for_status()
+            content = response.content
+            log.info(f"✓ {name} downloaded")
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+            if any(validators.values()):
+                try:
+                    MANIFEST_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                    write_cache_file(cache_body, content)
+                    write_cache_file(cache_meta, json_dumps(validators))
+                except OSError:
+                    pass
+        manifest = json_loads(content)
+        log.info("")
         return manifest
     except Exception as e:
-        print(f"✗ Failed to download {name}: {e}")
+        log.error(f"✗ Failed to download {name}: {e}")
         return None
 
+@lru_cache(maxsize=None)
 def parse_version(version_str):
     """Convert version string to tuple of integers for comparison"""
     return tuple(int(x) for x in version_str.split('.'))
 
-def get_highest_version(manifest, guid, plugin_name):
+def index_manifest(manifest):
+    """Index manifest plugins by GUID for constant-time lookups"""
+    return {p['guid']: p for p in manifest if 'guid' in p}
+
+def get_highest_version(plugins_by_guid, guid, plugin_name):
     """Get the version with the highest targetAbi for a given plugin GUID"""
-    print(f"  Searching manifest for plugin GUID: {guid}")
+    log.info(f"  Searching manifest for plugin GUID: {guid}")
     
     # Find the plugin
-    plugin = None
-    for p in manifest:
-        if p.get('guid') == guid:
-            plugin = p
-            break
+    plugin = plugins_by_guid.get(guid)
     
     if not plugin:
-        print(f"  ✗ Plugin not found in manifest")
+        log.error(f"  ✗ Plugin not found in manifest")
         return None, None
     
-    # Sort versions by targetAbi (descending)
+    # Pick the version with the highest targetAbi
     versions = plugin.get('versions', [])
     if not versions:
-        print(f"  ✗ No versions found for plugin")
+        log.error(f"  ✗ No versions found for plugin")
         return None, None
     
-    sorted_versions = sorted(
-        versions,
-        key=lambda v: parse_version(v['targetAbi']),
-        reverse=True
-    )
-    
-    best = sorted_versions[0]
-    print(f"  ✓ Found version {best['version']} for server {best['targetAbi']}")
-    print(f"  Source: {best['sourceUrl']}")
+    best = max(versions, key=lambda v: parse_version(v['targetAbi']))
+    log.info(f"  ✓ Found version {best['version']} for server {best['targetAbi']}")
+    log.info(f"  Source: {best['sourceUrl']}")
     
     # Return both version info and plugin metadata
     return best, plugin
 
-def download_file(url, dest_path):
-    """Download a file from URL to destination path"""
+def download_file(url):
+    """Download a file from URL into a temporary file object, or None on failure
+
+    Small files stay in memory; anything over 8 MiB spills to disk.
+    """
+    archive = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
     try:
-        req = urllib.request.Request(url, headers=HEADERS)
-        with urllib.request.urlopen(req) as response:
-            with open(dest_path, 'wb') as out_file:
-                out_file.write(response.read())
-        return True
+        with SESSION.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            # Only trust Content-Length for unencoded bodies; iter_content decodes gzip/deflate
+            expected_size = None
+            if 'Content-Encoding' not in response.headers and 'Content-Length' in response.headers:
+                expected_size = int(response.headers['Content-Length'])
+
+            written = 0
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                archive.write(chunk)
+                written += len(chunk)
+
+        if expected_size is not None and written != expected_size:
+            raise IOError(f"truncated download ({written} of {expected_size} bytes)")
+        archive.seek(0)
+        return archive
     except Exception as e:
-        print(f"  ✗ Download failed: {e}")
-        return False
+        log.error(f"  ✗ Download failed: {e}")
+        archive.close()
+        return None
 
-def find_image_file(target_dir):
-    """Find an image file in the plugin directory for imagePath"""
-    image_extensions = ['*.png', '*.jpg', '*.jpeg', '*.svg', '*.gif']
-    for ext in image_extensions:
-        matches = glob.glob(str(target_dir / ext))
-        if matches:
+def find_image_file(target_dir, names):
+    """Find an image file for imagePath among the archive members extracted to target_dir"""
+    # Only top-level members count, remembering the first match per extension
+    matches = {}
+    for name in names:
+        ext = os.path.splitext(name)[1]
+        if '/' not in name and ext in IMAGE_EXTS and ext not in matches:
+            matches[ext] = name
+
+    # Earlier extensions take priority
+    for ext in IMAGE_EXTS:
+        if ext in matches:
             # Return the path relative to /config/plugins
-            return matches[0].replace('/jellyfin/plugins', '/config/plugins')
+            return str(target_dir / matches[ext]).replace('/jellyfin/plugins', '/config/plugins')
     return ""
 
-def create_meta_json(target_dir, plugin_metadata, version_info, plugin_name):
+def create_meta_json(target_dir, plugin_metadata, version_info, plugin_name, image_path=""):
     """Create meta.json file for the plugin"""
     
-    # Find image file in the extracted plugin
-    image_path = find_image_file(target_dir)
-    
     meta = {
         "category": plugin_metadata.get('category', 'General'),
         "changelog": version_info.get('changelog', ''),
@@ -121,119 +245,119 @@ def create_meta_json(target_dir, plugin_metadata, version_info, plugin_name):
     
     meta_path = target_dir / "meta.json"
     try:
-        with open(meta_path, 'w') as f:
-            json.dump(meta, f, indent=2)
-        print(f"  ✓ Created meta.json")
+        meta_path.write_bytes(json_dumps(meta))
+        log.info(f"  ✓ Created meta.json")
         return True
     except Exception as e:
-        print(f"  ✗ Failed to create meta.json: {e}")
+        log.error(f"  ✗ Failed to create meta.json: {e}")
         return False
 
-def install_plugin(manifest, plugin_name, guid, plugin_dir, env_var_name=None):
-    """Download and install a plugin"""
-    print()
-    print(f"=== Installing {plugin_name} ===")
-    
-    version_info, plugin_metadata = get_highest_version(manifest, guid, plugin_name)
-    if not version_info:
-        print(f"  ✗ Failed to find plugin in manifest")
-        return False
-    
-    version = version_info['version']
-    target_abi = version_info['targetAbi']
-    source_url = version_info['sourceUrl']
-    
-    # Download
-    print(f"  Downloading {plugin_name} {version} (for server {target_abi})...")
-    temp_zip = f"/tmp/{plugin_name}.zip"
-    
-    if not download_file(source_url, temp_zip):
-        return False
-    
-    # Extract
-    target_dir = Path(plugin_dir) / f"{plugin_name}_{version}"
+def extract_plugin(archive, plugin_dir, plugin_name, plugin_metadata, version_info):
+    """Extract a downloaded plugin archive to <plugin_name>_<version> and create its meta.json
+
+    Returns True on success; a partially extracted plugin is removed on failure
+    """
+    target_dir = Path(plugin_dir) / f"{plugin_name}_{version_info['version']}"
     target_dir.mkdir(parents=True, exist_ok=True)
     
     try:
-        with zipfile.ZipFile(temp_zip, 'r') as zip_ref:
+        with archive, zipfile.ZipFile(archive, 'r') as zip_ref:
             zip_ref.extractall(target_dir)
-        print(f"  ✓ Installed to {target_dir}")
-        os.remove(temp_zip)
+            # Find image file in the extracted plugin from the archive listing
+            image_path = find_image_file(target_dir, zip_ref.namelist())
+        log.info(f"  ✓ Installed to {target_dir}")
         
-        # Create meta.json
-        create_meta_json(target_dir, plugin_metadata, version_info, plugin_name)
-        
-        # Store version in environment file
-        if env_var_name is None:
-            var_name_map = {
-                "CustomTabs": "CUSTOMTABS_VERSION",
-                "PluginPages": "PLUGINPAGES_VERSION",
-            }
-            env_var_name = var_name_map.get(plugin_name, f"{plugin_name.upper()}_VERSION")
-        
-        with open('/etc/environment', 'a') as f:
-            f.write(f"{env_var_name}={version}\n")
-        
-        print(f"  {env_var_name}={version} (built for Jellyfin {target_abi})")
+        create_meta_json(target_dir, plugin_metadata, version_info, plugin_name, image_path)
         return True
         
     except Exception as e:
-        print(f"  ✗ Extraction failed: {e}")
+        log.error(f"  ✗ Extraction failed: {e}")
         if target_dir.exists():
-            import shutil
             shutil.rmtree(target_dir)
-        if os.path.exists(temp_zip):
-            os.remove(temp_zip)
         return False
 
+def install_plugin(plugins_by_guid, plugin_name, guid, plugin_dir, env_var_name=None):
+    """Download and install a plugin
+
+    Returns (env_var_name, version) on success, or None on failure
+    """
+    log.info("")
+    log.info(f"=== Installing {plugin_name} ===")
+    
+    version_info, plugin_metadata = get_highest_version(plugins_by_guid, guid, plugin_name)
+    if not version_info:
+        log.error(f"  ✗ Failed to find plugin in manifest")
+        return None
+    
+    version = version_info['version']
+    target_abi = version_info['targetAbi']
+    source_url = version_info['sourceUrl']
+    
+    # Store version in environment file
+    if env_var_name is None:
+        env_var_name = ENV_VAR_MAP.get(plugin_name, f"{plugin_name.upper()}_VERSION")
+    
+    # A meta.json is only written after a successful extraction, so this version is complete
+    if (Path(plugin_dir) / f"{plugin_name}_{version}" / "meta.json").exists():
+        log.info(f"  ✓ {plugin_name} {version} already installed, skipping download")
+        return env_var_name, version
+    
+    # Download
+    log.info(f"  Downloading {plugin_name} {version} (for server {target_abi})...")
+    archive = download_file(source_url)
+    if archive is None:
+        return None
+    
+    # Extract and create meta.json
+    if not extract_plugin(archive, plugin_dir, plugin_name, plugin_metadata, version_info):
+        return None
+    
+    log.info(f"  {env_var_name}={version} (built for Jellyfin {target_abi})")
+    return env_var_name, version
+
 def install_customtabs_plugin(plugin_dir):
-    """Install CustomTabs plugin from soultaco83 repo (always latest release)"""
-    print()
-    print("=== Installing CustomTabs ===")
-    print("  Note: CustomTabs is from soultaco83 repo for master branch compatibility")
+    """Install CustomTabs plugin from soultaco83 repo (always latest release)
+
+    Returns (env_var_name, version) on success, or None on failure
+    """
+    log.info("")
+    log.info("=== Installing CustomTabs ===")
+    log.info("  Note: CustomTabs is from soultaco83 repo for master branch compatibility")
     
     try:
         # Get latest release from GitHub API
         api_url = "https://api.github.com/repos/soultaco83/jellyfin-plugin-custom-tabs/releases/latest"
-        print(f"  Fetching latest release from GitHub API...")
+        log.info(f"  Fetching latest release from GitHub API...")
         
-        with urllib.request.urlopen(api_url) as response:
-            release_info = json.loads(response.read())
+        with SESSION.get(api_url, timeout=REQUEST_TIMEOUT) as response:
+            response.raise_for_status()
+            release_info = json_loads(response.content)
         
         release_tag = release_info['tag_name']
-        print(f"  Latest release: {release_tag}")
+        log.info(f"  Latest release: {release_tag}")
         
         # Find the zip asset in the release
         download_url = None
         for asset in release_info.get('assets', []):
             if asset['name'].endswith('.zip'):
                 download_url = asset['browser_download_url']
-                print(f"  Found asset: {asset['name']}")
+                log.info(f"  Found asset: {asset['name']}")
                 break
         
         if not download_url:
-            print("  ✗ No zip file found in release assets")
-            return False
+            log.error("  ✗ No zip file found in release assets")
+            return None
         
         # Use fixed version for consistency
         version = "1.0.0.0"
         
-        print(f"  Version: {version}")
-        print(f"  Downloading from: {download_url}")
-        temp_zip = "/tmp/customtabs.zip"
-        
-        if not download_file(download_url, temp_zip):
-            return False
-        
-        target_dir = Path(plugin_dir) / f"CustomTabs_{version}"
-        target_dir.mkdir(parents=True, exist_ok=True)
-        
-        with zipfile.ZipFile(temp_zip, 'r') as zip_ref:
-            zip_ref.extractall(target_dir)
-        
-        print(f"  ✓ Installed to {target_dir}")
+        log.info(f"  Version: {version}")
+        log.info(f"  Downloading from: {download_url}")
+        archive = download_file(download_url)
+        if archive is None:
+            return None
         
-        # Create meta.json for CustomTabs
+        # Metadata for the CustomTabs meta.json
         plugin_metadata = {
             "guid": "fbacd0b6-fd46-4a05-b0a4-2045d6a135b0",
             "name": "Custom Tabs",
@@ -250,68 +374,79 @@ def install_customtabs_plugin(plugin_dir):
             "timestamp": release_info.get('published_at', '')
         }
         
-        create_meta_json(target_dir, plugin_metadata, version_info, "CustomTabs")
+        # Extract and create meta.json
+        if not extract_plugin(archive, plugin_dir, "CustomTabs", plugin_metadata, version_info):
+            return None
         
-        with open('/etc/environment', 'a') as f:
-            f.write(f"CUSTOMTABS_VERSION={version}\n")
-        
-        os.remove(temp_zip)
-        return True
+        return "CUSTOMTABS_VERSION", version
         
     except Exception as e:
-        print(f"  ✗ Failed to install CustomTabs: {e}")
-        return False
+        log.error(f"  ✗ Failed to install CustomTabs: {e}")
+        return None
 
 
 def main():
+    # Plugins install concurrently; logging serializes their output where print would interleave
+    # and stdout stays block-buffered when piped to "docker build", as it was with print
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[BufferedStreamHandler(sys.stdout)])
+
     # Get plugin directory from command line or use default
     plugin_dir = sys.argv[1] if len(sys.argv) > 1 else "/jellyfin/plugins"
-    print(f"Plugin Directory: {plugin_dir}")
-    print()
+    log.info(f"Plugin Directory: {plugin_dir}")
+    log.info("")
     
     # Create plugin directory
     Path(plugin_dir).mkdir(parents=True, exist_ok=True)
     
-    # Download main manifest
-    manifest = download_manifest(MANIFEST_URL, "IAmParadox manifest")
-    if not manifest:
-        print("⚠ IAmParadox manifest unavailable — skipping PluginPages")
-
-    # Install plugins
-    success_count = 0
-    fail_count = 0
-
-    # Plugins from IAmParadox manifest (CustomTabs uses soultaco83 repo instead)
-    # if manifest:
-    #     plugins = [
-    #         ("PluginPages", "5b6550fa-a014-4f4c-8a2c-59a43680ac6d")
-    #     ]
-    #
-    #     for plugin_name, guid in plugins:
-    #         if install_plugin(manifest, plugin_name, guid, plugin_dir):
-    #             success_count += 1
-    #         else:
-    #             fail_count += 1
-
-    # Install CustomTabs from soultaco83 repo (master branch compatible)
-    # if install_customtabs_plugin(plugin_dir):
-    #     success_count += 1
-    # else:
-    #     fail_count += 1
+    # Downloads are network-bound, so the manifest and all plugins are fetched concurrently
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        # Download main manifest
+        manifest_future = executor.submit(download_manifest, MANIFEST_URL, "IAmParadox manifest")
+
+        # Plugin installs in flight
+        installs = []
+
+        # Install CustomTabs from soultaco83 repo (master branch compatible); it does
+        # not need the manifest, so it starts while the manifest is still downloading
+        # installs.append(executor.submit(install_customtabs_plugin, plugin_dir))
+
+        manifest = manifest_future.result()
+        if not manifest:
+            log.warning("⚠ IAmParadox manifest unavailable — skipping PluginPages")
+
+        # Plugins from IAmParadox manifest (CustomTabs uses soultaco83 repo instead)
+        # if manifest:
+        #     plugins_by_guid = index_manifest(manifest)
+        #     plugins = [
+        #         ("PluginPages", "5b6550fa-a014-4f4c-8a2c-59a43680ac6d")
+        #     ]
+        #
+        #     for plugin_name, guid in plugins:
+        #         installs.append(executor.submit(install_plugin, plugins_by_guid, plugin_name, guid, plugin_dir))
+
+        results = [install.result() for install in installs]
+
+    # Store the installed versions in the environment file in one write
+    env_lines = [result for result in results if result]
+    if env_lines:
+        with open('/etc/environment', 'a') as f:
+            f.writelines(f"{name}={version}\n" for name, version in env_lines)
 
+    success_count = len(env_lines)
+    fail_count = len(results) - success_count
 
     # Summary
-    print()
-    print("=== Installation Summary ===")
-    print(f"Successful: {success_count}")
-    print(f"Failed: {fail_count}")
-    print()
+    log.info("")
+    log.info("=== Installation Summary ===")
+    log.info(f"Successful: {success_count}")
+    log.info(f"Failed: {fail_count}")
+    log.info("")
     
     if fail_count > 0:
-        print("⚠ Warning: Some plugins failed to install")
+        log.warning("⚠ Warning: Some plugins failed to install")
         sys.exit(0)  # Don't fail the build, just warn
     
-    print("✓ All plugins installed successfully")
+    log.info("✓ All plugins installed successfully")
     sys.exit(0)
 
 if __name__ == "__main__":